@@ -1,9 +1,12 @@
-import json
+import asyncio
 import os
+from collections.abc import Coroutine
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 
+import orjson
+
 # TODO(konsti): Provider a way to set the root in the CLI and derive all paths from that.
 root_dir = Path(
     os.environ.get("UV_ECOSYSTEM_TESTING_ROOT") or Path(__file__).parent.parent.parent
@@ -18,6 +21,8 @@ top_15k_pypi = data_dir.joinpath("top-15k-pypi.csv")
 top_15k_pypi_latest_version = data_dir.joinpath("top-15k-pypi-latest-version.csv")
 
 pyproject_tomls_dir = root_dir.joinpath("pyproject_tomls")
+# The downloaded `pyproject.toml` files with their ETags, to skip unchanged files
+pyproject_tomls_cache_dir = root_dir.joinpath("pyproject_tomls_cache")
 
 cache_dir = root_dir.joinpath("cache")
 
@@ -29,7 +34,7 @@ class Mode(Enum):
     SYNC = "sync"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RunConfig:
     """The parameters of a run, stored in a JSON file in the output directory."""
 
@@ -39,12 +44,27 @@ class RunConfig:
     i_am_in_docker: bool
 
     def write(self, output_dir: Path):
-        data = self.__dict__.copy()
-        data["mode"] = self.mode.value if isinstance(self.mode, Mode) else self.mode
-        output_dir.joinpath("parameters.json").write_text(json.dumps(data))
+        # orjson serializes the dataclass and the mode enum natively
+        output_dir.joinpath("parameters.json").write_bytes(orjson.dumps(self))
 
     @staticmethod
     def read(output_dir: Path) -> "RunConfig":
-        parameters = json.loads(output_dir.joinpath("parameters.json").read_text())
+        # The file is tiny and read once per output directory, a plain read is faster
+        # than mapping it.
+        parameters = orjson.loads(output_dir.joinpath("parameters.json").read_bytes())
         parameters["mode"] = Mode(parameters["mode"])
         return RunConfig(**parameters)
+
+
+def run_async(main: Coroutine):
+    """Like `asyncio.run`, but use uvloop if it is installed.
+
+    The fetch scripts run thousands of concurrent requests and the resolve runs
+    supervise many uv processes, uvloop has lower scheduling overhead than the
+    default event loop for both.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(main)
+    return asyncio.run(main, loop_factory=uvloop.new_event_loop)
@@ -11,7 +11,7 @@ import orjson
 from httpx import AsyncClient, HTTPError
 from tqdm.asyncio import tqdm
 
-from uv_ecosystem_testing import top_15k_pypi, top_15k_pypi_latest_version
+from uv_ecosystem_testing import run_async, top_15k_pypi, top_15k_pypi_latest_version
 
 
 async def get_latest_version(
@@ -62,7 +62,7 @@ def main() -> None:
     parser.add_argument("--input-file", type=Path, default=top_15k_pypi)
     parser.add_argument("--output-file", type=Path, default=top_15k_pypi_latest_version)
     args = parser.parse_args()
-    asyncio.run(get_latest_versions(args.input_file, args.output_file))
+    run_async(get_latest_versions(args.input_file, args.output_file))
 
 
 if __name__ == "__main__":
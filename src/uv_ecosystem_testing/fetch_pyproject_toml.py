@@ -1,24 +1,69 @@
 import argparse
 import asyncio
 import csv
+import os
+import random
 import shutil
 from dataclasses import dataclass
 from pathlib import Path
 
 import httpx
+import orjson
 from httpx import AsyncClient
 from tqdm.auto import tqdm
 
-from uv_ecosystem_testing import pyproject_tomls_dir
+from uv_ecosystem_testing import (
+    pyproject_tomls_cache_dir,
+    pyproject_tomls_dir,
+    run_async,
+)
 
+pyproject_toml_url = (
+    "https://raw.githubusercontent.com/{org}/{repo}/{ref}/pyproject.toml"
+)
+# All files come from raw.githubusercontent.com, so we keep a pool of connections
+# to that host open and multiplex the requests over HTTP/2.
+max_connections = 100
+# How much of a response body to collect before writing it out
+write_buffer_size = 1024 * 1024
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class Repository:
     org: str
     repo: str
     ref: str
 
 
+@dataclass
+class ResponseCache:
+    """Downloaded files and their ETags, stored across runs.
+
+    Files that are in the cache are requested with `If-None-Match`, so unchanged
+    files are a `304 Not Modified` without a body.
+    """
+
+    root: Path
+    etags: dict[str, str]
+
+    def path(self, url: str) -> Path:
+        # Mirror the path of the URL, e.g. `{org}/{repo}/{ref}/pyproject.toml`
+        return self.root.joinpath(httpx.URL(url).path.lstrip("/"))
+
+    def write(self):
+        self.root.joinpath("etags.json").write_bytes(orjson.dumps(self.etags))
+
+    @staticmethod
+    def read(root: Path) -> "ResponseCache":
+        root.mkdir(parents=True, exist_ok=True)
+        write_gitignore(root)
+        try:
+            etags = orjson.loads(root.joinpath("etags.json").read_bytes())
+        except FileNotFoundError:
+            etags = {}
+        return ResponseCache(root=root, etags=etags)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -28,91 +73,243 @@ def main():
         help="csv file(s) with a `repo_name` culumn and optionally a `ref` column",
     )
     parser.add_argument("--output", type=Path, default=pyproject_tomls_dir)
-    parser.add_argument("--keep", action="store_true")
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the existing files and only download the missing ones",
+    )
+    parser.add_argument("--cache", type=Path, default=pyproject_tomls_cache_dir)
     args = parser.parse_args()
 
-    asyncio.run(fetch_all_pyproject_toml(args.input, args.output, args.keep))
+    run_async(fetch_all_pyproject_toml(args.input, args.output, args.keep, args.cache))
 
 
 async def fetch_all_pyproject_toml(
-    repositories_files: list[Path], output: Path, keep: bool = False
+    repositories_files: list[Path],
+    output: Path,
+    keep: bool = False,
+    cache: Path = pyproject_tomls_cache_dir,
 ):
-    repositories = []
-    seen = set()
+    # Keyed by repo name to avoid duplicates, preserving the input order
+    repositories_by_name: dict[str, Repository] = {}
     for repositories_file in repositories_files:
         with repositories_file.open() as f:
-            # Avoid duplicates
-            for row in csv.DictReader(f):
-                if row["repo_name"] in seen:
+            reader = csv.reader(f)
+            header = next(reader)
+            repo_name_index = header.index("repo_name")
+            ref_index = header.index("ref") if "ref" in header else None
+            for row in reader:
+                repo_name = row[repo_name_index]
+                if repo_name in repositories_by_name:
                     continue
-                seen.add(row["repo_name"])
-                repositories.append(
-                    Repository(
-                        org=row["repo_name"].split("/")[0],
-                        repo=row["repo_name"].split("/")[1],
-                        # Use master so we try to master and main
-                        ref=row.get("ref", "refs/heads/master"),
-                    )
+                org, _, repo = repo_name.partition("/")
+                repositories_by_name[repo_name] = Repository(
+                    org=org,
+                    repo=repo,
+                    # Use master so we try to master and main
+                    ref=row[ref_index]
+                    if ref_index is not None
+                    else "refs/heads/master",
                 )
+    repositories = list(repositories_by_name.values())
 
-    if not keep and output.exists():
+    if keep and output.is_dir():
+        # A single directory listing instead of checking each file
+        with os.scandir(output) as entries:
+            existing = {entry.name for entry in entries}
+        repositories = [
+            repository
+            for repository in repositories
+            if f"{repository.repo}.toml" not in existing
+        ]
+        print(
+            f"Keeping existing files: {len(repositories_by_name) - len(repositories)}"
+        )
+    elif output.exists():
         shutil.rmtree(output)
-    output.mkdir(parents=True)
-    output.joinpath(".gitignore").write_text("*\n")
+    output.mkdir(parents=True, exist_ok=True)
+    write_gitignore(output)
+    response_cache = ResponseCache.read(cache)
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections // 2,
+        keepalive_expiry=30,
+    )
+    timeout = httpx.Timeout(30.0, connect=10.0)
+    results = []
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+        with tqdm(total=len(repositories)) as pbar:
+            # The connection pool limits the concurrent requests. Instead of a task
+            # per repository, `max_connections` workers take the repositories from a
+            # shared iterator, so the number of live tasks is bounded, too.
+            pending = iter(repositories)
 
-    semaphore = asyncio.Semaphore(50)
+            async def worker():
+                for repository in pending:
+                    results.append(
+                        await fetch_one(client, repository, output, response_cache)
+                    )
+                    pbar.update(1)
 
-    async def fetch_with_semaphore(
-        client: AsyncClient, repository: Repository, output_dir: Path
-    ):
-        async with semaphore:
-            return await fetch_one(client, repository, output_dir)
+            async with asyncio.TaskGroup() as task_group:
+                for _ in range(max_connections):
+                    task_group.create_task(worker())
 
-    async with httpx.AsyncClient() as client:
-        with tqdm(total=len(repositories)) as pbar:
-            tasks = [
-                fetch_with_semaphore(client, repository, output)
-                for repository in repositories
-            ]
-            results = []
-            for future in asyncio.as_completed(tasks):
-                results.append(await future)
-                pbar.update(1)
+    response_cache.write()
 
     success = sum(1 for result in results if result is True)
     print(f"Successes: {success}/{len(repositories)}")
 
 
-async def fetch_one(client: AsyncClient, repository: Repository, output_dir: Path):
-    url = f"https://raw.githubusercontent.com/{repository.org}/{repository.repo}/{repository.ref}/pyproject.toml"
+async def fetch_one(
+    client: AsyncClient,
+    repository: Repository,
+    output_dir: Path,
+    response_cache: ResponseCache,
+):
+    path = output_dir.joinpath(f"{repository.repo}.toml")
+    url = pyproject_toml_url.format(
+        org=repository.org, repo=repository.repo, ref=repository.ref
+    )
     try:
-        response = await client.get(url)
-        response.raise_for_status()
+        await download(client, url, path, response_cache)
     except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            tqdm.write(
+                f"Error for https://github.com/{repository.org}/{repository.repo}: {e}"
+            )
+            return None
+        if repository.ref == "refs/heads/main":
+            tqdm.write(
+                f"Not found: https://github.com/{repository.org}/{repository.repo}"
+            )
+            return None
         # The bigquery data is sometimes missing the master -> main transition
-        url = f"https://raw.githubusercontent.com/{repository.org}/{repository.repo}/refs/heads/main/pyproject.toml"
+        url = pyproject_toml_url.format(
+            org=repository.org, repo=repository.repo, ref="refs/heads/main"
+        )
         try:
-            response = await client.get(url)
-            response.raise_for_status()
+            await download(client, url, path, response_cache)
         except httpx.HTTPError:
             # Ignore the error from the main fallback if it didn't work
-            if e.response.status_code == 404:
-                tqdm.write(
-                    f"Not found: https://github.com/{repository.org}/{repository.repo}"
-                )
-            else:
-                tqdm.write(
-                    f"Error for https://github.com/{repository.org}/{repository.repo}: {e}"
-                )
+            tqdm.write(
+                f"Not found: https://github.com/{repository.org}/{repository.repo}"
+            )
             return None
     except httpx.HTTPError as e:
         tqdm.write(
             f"Error for https://github.com/{repository.org}/{repository.repo}: {e}"
         )
         return None
-    output_dir.joinpath(f"{repository.repo}.toml").write_text(response.text)
     return True
 
 
+async def download(
+    client: AsyncClient,
+    url: str,
+    path: Path,
+    response_cache: ResponseCache,
+    retries: int = 3,
+):
+    """Download the response body to `path`, retrying transient errors with backoff.
+
+    The body is written to the response cache and to `path`. If the cached file is
+    still current, the server returns a 304 and we only copy it.
+    """
+    cached = response_cache.path(url)
+    headers = {}
+    if (etag := response_cache.etags.get(url)) and cached.is_file():
+        headers["If-None-Match"] = etag
+    # Build the request once and reuse it for the retries
+    request = client.build_request("GET", url, headers=headers)
+    for attempt in range(retries + 1):
+        try:
+            response = await client.send(request, stream=True)
+            try:
+                if response.status_code == httpx.codes.NOT_MODIFIED:
+                    await asyncio.to_thread(shutil.copyfile, cached, path)
+                    return
+                response.raise_for_status()
+                await stream_download(response, cached, path)
+            finally:
+                await response.aclose()
+            if etag := response.headers.get("etag"):
+                response_cache.etags[url] = etag
+            else:
+                response_cache.etags.pop(url, None)
+            return
+        except httpx.HTTPError as e:
+            if attempt == retries or not is_transient(e):
+                raise
+        await asyncio.sleep(2**attempt + random.random())
+
+
+async def stream_download(response: httpx.Response, cached: Path, path: Path):
+    """Write the body to the response cache and to `path` while it arrives.
+
+    At most `write_buffer_size` bytes of the body are held in memory. The writes run
+    in a worker thread, one call per buffer, so a typical `pyproject.toml` is written
+    in a single call. If the transfer fails, both files are removed.
+    """
+    files = []
+    chunks = []
+    buffered = 0
+    try:
+        async for chunk in response.aiter_bytes(64 * 1024):
+            chunks.append(chunk)
+            buffered += len(chunk)
+            if buffered >= write_buffer_size:
+                await asyncio.to_thread(write_download, files, chunks, cached, path)
+                chunks, buffered = [], 0
+        await asyncio.to_thread(write_download, files, chunks, cached, path, True)
+    except BaseException:
+        if files:
+            await asyncio.to_thread(discard_download, files, cached, path)
+        raise
+
+
+def write_download(
+    files: list, chunks: list[bytes], cached: Path, path: Path, last: bool = False
+):
+    """Write a part of a download to the response cache and to `path`.
+
+    The files are opened on the first call and kept in `files`, and closed after the
+    last part.
+    """
+    if not files:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        files.append(cached.open("wb"))
+        files.append(path.open("wb"))
+    for f in files:
+        f.writelines(chunks)
+    if last:
+        for f in files:
+            f.close()
+
+
+def discard_download(files: list, cached: Path, path: Path):
+    """Remove the files of a failed download, so there are no partial files."""
+    for f in files:
+        f.close()
+    cached.unlink(missing_ok=True)
+    path.unlink(missing_ok=True)
+
+
+def write_gitignore(directory: Path):
+    """Ignore the contents of the directory, unless it is already ignored."""
+    gitignore = directory.joinpath(".gitignore")
+    if not gitignore.exists():
+        gitignore.write_text("*\n")
+
+
+def is_transient(error: httpx.HTTPError) -> bool:
+    """Whether a request is worth retrying: rate limits, server and network errors."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
 if __name__ == "__main__":
     main()
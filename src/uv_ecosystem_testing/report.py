@@ -1,13 +1,39 @@
 import argparse
 import difflib
-import json
+import filecmp
+import io
+import os
 import re
 import sys
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import TextIO
 
+import orjson
+
 from uv_ecosystem_testing import Mode, RunConfig
 
+try:
+    # `difflib.unified_diff` is dominated by `SequenceMatcher`, use the C
+    # implementation if it is installed.
+    from cdifflib import CSequenceMatcher
+
+    difflib.SequenceMatcher = CSequenceMatcher
+except ImportError:
+    pass
+
+try:
+    # Use RE2 if it is installed, it matches in linear time and supports the pattern.
+    import re2 as regex_engine
+except ImportError:
+    regex_engine = re
+
+# Supress noise from fluctuations in execution time. This runs on the raw bytes, we
+# only decode after redacting.
+redact_time = regex_engine.compile(rb"(0\.)?(\d+)ms|(\d+)\.(\d+)s")
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -15,15 +41,23 @@ def main():
     parser.add_argument("branch", type=Path)
     parser.add_argument("--markdown", action="store_true")
     args = parser.parse_args()
-    create_report(args.base, args.branch, args.markdown)
+    if args.markdown:
+        create_report(args.base, args.branch, writer=None, markdown_writer=sys.stdout)
+    else:
+        create_report(args.base, args.branch)
 
 
 def create_report(
-    base: Path, branch: Path, markdown: bool = False, writer: TextIO = sys.stdout
+    base: Path,
+    branch: Path,
+    writer: TextIO | None = sys.stdout,
+    markdown_writer: TextIO | None = None,
 ) -> None:
-    # Supress noise from fluctuations in execution time
-    redact_time = re.compile(r"(0\.)?(\d+)ms|(\d+).(\d+)s")
+    """Compare the outputs of base and branch.
 
+    Writes the text report to `writer` and the markdown report to `markdown_writer`,
+    if they are set. Both reports share a single pass over the packages.
+    """
     parameters = RunConfig.read(base)
     parameters_branch = RunConfig.read(branch)
     if parameters != parameters_branch:
@@ -34,76 +68,80 @@ def create_report(
     total = 0
     successful_base = 0
     regressions = 0
+    # Only the names of the packages with differences, their outputs are loaded again
+    # for writing the diffs, so we don't need to keep all of them in memory.
     differences = []
     fixed = []
-    files = sorted(dir for dir in base.iterdir() if dir.is_dir())
-    for package_base in files:
-        package = package_base.name
-        package_branch = branch.joinpath(package)
-        if not package_branch.is_dir():
-            writer.write(f"Package {package} not found in branch\n")
-            continue
+    # `DirEntry.is_dir` uses the file type from the directory listing, saving a
+    # `stat` call per package.
+    with os.scandir(base) as entries:
+        packages = sorted(
+            entry.name for entry in entries if entry.is_dir(follow_symlinks=False)
+        )
+    with os.scandir(branch) as entries:
+        packages_branch = {
+            entry.name for entry in entries if entry.is_dir(follow_symlinks=False)
+        }
+    for package in packages:
+        if package not in packages_branch:
+            for report_writer in [writer, markdown_writer]:
+                if report_writer is not None:
+                    report_writer.write(f"Package {package} not found in branch\n")
+    packages = [package for package in packages if package in packages_branch]
 
+    for output in load_packages(packages, base, branch, parameters.mode):
         total += 1
-
-        summary_base = package_base.joinpath("summary.json").read_text()
-        summary_branch = package_branch.joinpath("summary.json").read_text()
-        if json.loads(summary_base)["exit_code"] == 0:
+        if output.exit_code == 0:
             successful_base += 1
         else:
-            if json.loads(summary_branch)["exit_code"] == 0:
-                fixed.append(package)
+            if output.exit_code_branch == 0:
+                fixed.append(output.package)
             # Don't show differences in the error messages,
             # also `uv.lock` doesn't exist for failed resolutions
             continue
 
-        if parameters.mode == Mode.COMPILE:
-            resolution = package_base.joinpath("stdout.txt").read_text()
-        else:
-            resolution = package_base.joinpath("uv.lock").read_text()
-            if package_base.joinpath("stdout.txt").read_text().strip():
-                raise RuntimeError(f"Stdout not empty (base): {package}")
-        stderr = package_base.joinpath("stderr.txt").read_text()
-        stderr = redact_time.sub(r"[TIME]", stderr)
-
-        if parameters.mode == Mode.COMPILE:
-            resolution_branch = package_branch.joinpath("stdout.txt").read_text()
-        else:
-            try:
-                resolution_branch = package_branch.joinpath("uv.lock").read_text()
-            except FileNotFoundError:
-                resolution_branch = "Package failed to resolve"
-                regressions += 1
-            if package_branch.joinpath("stdout.txt").read_text().strip():
-                raise RuntimeError(f"Stdout not empty (branch): {package}")
-        stderr_branch = package_branch.joinpath("stderr.txt").read_text()
-        stderr_branch = redact_time.sub(r"[TIME]", stderr_branch)
-        # Redact path differences:
-        # ```diff
-        # -   Building xlsx2csv @ file:///work/base/sync/xlsx2csv
-        # +   Building xlsx2csv @ file:///work/branch/sync/xlsx2csv
-        # ```
-        stderr_branch = stderr_branch.replace(str(branch), str(base))
-
-        if resolution != resolution_branch or stderr != stderr_branch:
-            differences.append(
-                (package, resolution, resolution_branch, stderr, stderr_branch)
-            )
+        if output.regression:
+            regressions += 1
+        if output.resolution is not None or output.stderr is not None:
+            differences.append(output.package)
+            # The text report has the counts at the end, so we can write the diff
+            # right away.
+            if writer is not None:
+                writer.write(text_section(output))
+
+    different = len(differences)
+    if writer is not None:
+        if fixed:
+            writer.write("--------------------------------\n")
+            writer.write("Packages fixed in branch\n")
+            for fixed_package in fixed:
+                writer.write(f"* {fixed_package}\n")
+            writer.write("\n")
 
-    if markdown:
         writer.write(
+            f"Successfully resolved packages: {successful_base}/{total} ({successful_base / total:.0%})\n"
+        )
+        if regressions > 0:
+            writer.write(f"Regressions: {regressions}\n")
+        if different == 0:
+            writer.write(f"All resolutions are identical ({successful_base} total).\n")
+        else:
+            writer.write(f"Different resolutions: {different}/{successful_base}\n")
+
+    if markdown_writer is not None:
+        markdown_writer.write(
             f"**{parameters.mode.value.replace('pyproject-toml', 'pyproject.toml')}**\n"
         )
         if parameters.mode in [Mode.PYPROJECT_TOML, Mode.SYNC]:
-            writer.write(
+            markdown_writer.write(
                 " * Dataset: A set of top level `pyproject.toml` from GitHub projects popular in 2025. "
                 + "Only `pyproject.toml` files with a `[project]` section and static dependencies are included.\n"
             )
         else:
-            writer.write(
+            markdown_writer.write(
                 " * Dataset: The top 15k PyPI packages. A handful of pathological cases were filtered out.\n"
             )
-        writer.write(
+        markdown_writer.write(
             " * Command: "
             + f"`{'uv pip compile' if parameters.mode == Mode.COMPILE else 'uv lock'}` "
             + ("with `--no-build` " if not parameters.i_am_in_docker else "")
@@ -115,112 +153,189 @@ def create_report(
             + f"on Python {parameters.python}."
             + "\n"
         )
-        writer.write(
+        markdown_writer.write(
             f" * Successfully resolved packages: {successful_base}/{total} ({successful_base / total:.0%}). "
             + "Only success resolutions can be compared.\n"
         )
         if regressions > 0:
-            writer.write(f" * **There were {regressions} regressions**\n")
-        writer.write("\n")
-        if len(differences) == 0:
-            writer.write(
+            markdown_writer.write(f" * **There were {regressions} regressions**\n")
+        markdown_writer.write("\n")
+        if different == 0:
+            markdown_writer.write(
                 f"All resolutions are identical ({successful_base} total).\n\n"
             )
         else:
-            writer.write(
-                f"Different resolutions: {len(differences)}/{successful_base}\n"
+            markdown_writer.write(
+                f"Different resolutions: {different}/{successful_base}\n"
             )
 
         if fixed:
-            writer.write("**Packages fixed in branch**\n")
+            markdown_writer.write("**Packages fixed in branch**\n")
             for fixed_package in fixed:
-                writer.write(f"* {fixed_package}\n")
-            writer.write("\n")
+                markdown_writer.write(f"* {fixed_package}\n")
+            markdown_writer.write("\n")
+
+        for output in load_packages(differences, base, branch, parameters.mode):
+            markdown_writer.write(markdown_section(output, parameters.mode))
+
+
+@dataclass
+class PackageOutput:
+    """The outputs of a package in base and branch.
 
-        for (
-            package,
-            resolution,
-            resolution_branch,
-            stderr,
-            stderr_branch,
-        ) in differences:
-            if parameters.mode == Mode.COMPILE:
-                n = 9999
-            else:
-                n = 3
-            writer.write(f"\n<details>\n<summary>{package}</summary>\n\n")
-            if resolution != resolution_branch:
-                writer.write("```diff\n")
-                writer.writelines(
-                    difflib.unified_diff(
-                        resolution.splitlines(keepends=True),
-                        resolution_branch.splitlines(keepends=True),
-                        fromfile="base",
-                        tofile="branch",
-                        n=n,
-                    )
-                )
-                writer.write("\n```\n")
-            if stderr != stderr_branch:
-                writer.write("```diff\n")
-                writer.writelines(
-                    difflib.unified_diff(
-                        stderr.splitlines(keepends=True),
-                        stderr_branch.splitlines(keepends=True),
-                        fromfile="base",
-                        tofile="branch",
-                        n=n,
-                    )
-                )
-                writer.write("```\n")
-            writer.write("</details>\n\n")
+    The exit code of branch is only loaded if base failed. The resolutions and
+    stderr are only loaded if base was successful and they differ between base and
+    branch, otherwise they are `None`.
+    """
+
+    package: str
+    exit_code: int
+    exit_code_branch: int | None = None
+    resolution: str | None = None
+    resolution_branch: str | None = None
+    stderr: str | None = None
+    stderr_branch: str | None = None
+    regression: bool = False
+
+
+def load_packages(
+    packages: list[str], base: Path, branch: Path, mode: Mode
+) -> Iterator[PackageOutput]:
+    """Load and compare the outputs of the packages in a thread pool, in order.
+
+    Loading and comparing the outputs is I/O bound. Only a bounded number of packages
+    is loaded ahead of the consumer, so the memory use doesn't grow with the number of
+    packages.
+    """
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        yield from executor.map(
+            lambda package: load_package(package, base, branch, mode),
+            packages,
+            buffersize=64,
+        )
+
+
+def load_package(package: str, base: Path, branch: Path, mode: Mode) -> PackageOutput:
+    """Load and compare the outputs of a package in base and branch."""
+    package_base = base.joinpath(package)
+    package_branch = branch.joinpath(package)
+    summary_base = orjson.loads(read_bytes(package_base.joinpath("summary.json")))
+    output = PackageOutput(package=package, exit_code=summary_base["exit_code"])
+    if output.exit_code != 0:
+        # We only need the branch exit code to tell whether the package was fixed
+        summary_branch = orjson.loads(
+            read_bytes(package_branch.joinpath("summary.json"))
+        )
+        output.exit_code_branch = summary_branch["exit_code"]
+        return output
+
+    if mode == Mode.COMPILE:
+        resolution = package_base.joinpath("stdout.txt")
+        resolution_branch = package_branch.joinpath("stdout.txt")
     else:
-        for (
-            package,
-            resolution,
-            resolution_branch,
-            stderr,
-            stderr_branch,
-        ) in differences:
-            writer.write("--------------------------------\n")
-            writer.write(f"Package {package}\n")
-            if resolution != resolution_branch:
-                writer.writelines(
-                    difflib.unified_diff(
-                        resolution.splitlines(keepends=True),
-                        resolution_branch.splitlines(keepends=True),
-                        fromfile="base",
-                        tofile="branch",
-                    )
-                )
-            if stderr != stderr_branch:
-                writer.writelines(
-                    difflib.unified_diff(
-                        stderr.splitlines(keepends=True),
-                        stderr_branch.splitlines(keepends=True),
-                        fromfile="base",
-                        tofile="branch",
-                    )
-                )
+        resolution = package_base.joinpath("uv.lock")
+        resolution_branch = package_branch.joinpath("uv.lock")
+        if read_bytes(package_base.joinpath("stdout.txt")).strip():
+            raise RuntimeError(f"Stdout not empty (base): {package}")
+        if read_bytes(package_branch.joinpath("stdout.txt")).strip():
+            raise RuntimeError(f"Stdout not empty (branch): {package}")
+    # Most resolutions are identical, compare the sizes and then the bytes before
+    # loading them as text for the diff. The comparison stats both files, so a
+    # missing lockfile in branch doesn't need a separate check.
+    try:
+        identical = filecmp.cmp(resolution, resolution_branch, shallow=False)
+    except FileNotFoundError:
+        if mode == Mode.COMPILE or resolution_branch.is_file():
+            raise
+        output.resolution = resolution.read_text()
+        output.resolution_branch = "Package failed to resolve"
+        output.regression = True
+    else:
+        if not identical:
+            text = resolution.read_text()
+            text_branch = resolution_branch.read_text()
+            # The text can still be the same, e.g., with different newlines
+            if text != text_branch:
+                output.resolution = text
+                output.resolution_branch = text_branch
 
-        if fixed:
-            writer.write("--------------------------------\n")
-            writer.write("Packages fixed in branch\n")
-            for fixed_package in fixed:
-                writer.write(f"* {fixed_package}\n")
-            writer.write("\n")
+    stderr = redact_time.sub(
+        rb"[TIME]", read_bytes(package_base.joinpath("stderr.txt"))
+    )
+    stderr_branch = redact_time.sub(
+        rb"[TIME]", read_bytes(package_branch.joinpath("stderr.txt"))
+    )
+    # Redact path differences:
+    # ```diff
+    # -   Building xlsx2csv @ file:///work/base/sync/xlsx2csv
+    # +   Building xlsx2csv @ file:///work/branch/sync/xlsx2csv
+    # ```
+    stderr_branch = stderr_branch.replace(os.fsencode(branch), os.fsencode(base))
+    # Compare the bytes, we only need to decode for the diff
+    if stderr != stderr_branch:
+        output.stderr = stderr.decode(errors="replace")
+        output.stderr_branch = stderr_branch.decode(errors="replace")
+    return output
 
-        writer.write(
-            f"Successfully resolved packages: {successful_base}/{total} ({successful_base / total:.0%})\n"
+
+def read_bytes(path: Path) -> bytes:
+    """Like `Path.read_bytes`, but with a single `read` and no buffered file object.
+
+    The report reads several small files for each package, where the overhead of
+    the file object is significant.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def markdown_section(output: PackageOutput, mode: Mode) -> str:
+    """The collapsible section with the diffs of a package in the markdown report."""
+    if mode == Mode.COMPILE:
+        n = 9999
+    else:
+        n = 3
+    # Collect the section of a package and write it at once
+    buffer = io.StringIO()
+    buffer.write(f"\n<details>\n<summary>{output.package}</summary>\n\n")
+    if output.resolution is not None:
+        buffer.write("```diff\n")
+        buffer.write(unified_diff(output.resolution, output.resolution_branch, n=n))
+        buffer.write("\n```\n")
+    if output.stderr is not None:
+        buffer.write("```diff\n")
+        buffer.write(unified_diff(output.stderr, output.stderr_branch, n=n))
+        buffer.write("```\n")
+    buffer.write("</details>\n\n")
+    return buffer.getvalue()
+
+
+def text_section(output: PackageOutput) -> str:
+    """The diffs of a package in the text report."""
+    # Collect the section of a package and write it at once
+    buffer = io.StringIO()
+    buffer.write("--------------------------------\n")
+    buffer.write(f"Package {output.package}\n")
+    if output.resolution is not None:
+        buffer.write(unified_diff(output.resolution, output.resolution_branch))
+    if output.stderr is not None:
+        buffer.write(unified_diff(output.stderr, output.stderr_branch))
+    return buffer.getvalue()
+
+
+def unified_diff(base: str, branch: str, n: int = 3) -> str:
+    """Diff two texts, joined into a single string so it can be written at once."""
+    return "".join(
+        difflib.unified_diff(
+            base.splitlines(keepends=True),
+            branch.splitlines(keepends=True),
+            fromfile="base",
+            tofile="branch",
+            n=n,
         )
-        if regressions > 0:
-            writer.write(f"Regressions: {regressions}\n")
-        if len(differences) == 0:
-            writer.write(f"All resolutions are identical ({successful_base} total).\n")
-        else:
-            writer.write(
-                f"Different resolutions: {len(differences)}/{successful_base}\n"
-            )
+    )
 
 
 if __name__ == "__main__":
@@ -1,18 +1,21 @@
 import argparse
-import concurrent.futures
+import asyncio
 import csv
-import json
+import itertools
 import os
 import platform
 import shutil
 import subprocess
 import time
 import tomllib
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
 from threading import Thread
 
+import orjson
 import tomli_w
 from tqdm.auto import tqdm
 
@@ -23,6 +26,7 @@ from uv_ecosystem_testing import (
     Mode,
     RunConfig,
     pyproject_tomls_dir,
+    run_async,
 )
 
 
@@ -34,34 +38,33 @@ class Summary:
     time: float
 
 
-def run_uv(
+async def run_uv(
     package: str,
     specification: str,
-    uv: Path,
+    command: list[Path | str],
     mode: Mode,
     python: str,
-    cache: Path,
-    offline: bool,
     output: Path,
-    i_am_in_docker: bool = False,
+    env: dict[str, str],
 ) -> Summary:
     """Resolve in a uv subprocess.
 
     The logic captures the max RSS from the process and avoids deadlocks from full
-    pipes.
+    pipes. `command` and `env` are the uv command and its environment, built once per
+    `resolve_all` run and shared between the packages of that run.
     """
     package_dir = output.joinpath(package)
     package_dir.mkdir()
-    command = prepare_uv_command(
-        specification, uv, mode, cache, offline, package_dir, python, i_am_in_docker
-    )
+    write_project(specification, mode, package_dir, python)
 
     start = time.time()
 
-    env = os.environ.copy()
-    if "VIRTUAL_ENV" in env:
-        del env["VIRTUAL_ENV"]
-
+    # We don't use `asyncio.create_subprocess_exec`, asyncio reaps the process itself,
+    # and we wouldn't get the resource usage.
+    #
+    # Keep the default `close_fds=True`: `cwd` already rules out `posix_spawn`, and on
+    # Linux, closing the fds costs a single `close_range` after `vfork`, so
+    # `close_fds=False` would only save about one syscall per process.
     process = subprocess.Popen(
         command,
         cwd=package_dir,
@@ -69,50 +72,84 @@ def run_uv(
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-    )
-
-    stdout, stderr = communicate(
-        process, specification if mode == Mode.COMPILE else None
     )
 
-    # At this point the process should be finished, stdout and stderr being closed usually means that.
-    # The process is a zombie, so has called `exit()`, but we haven't reaped it with `wait`/`wait4` yet.
-
-    # rusage is only available on unix
-    if os.name == "posix":
-        # Reap the process to get resource usage information.
-        _pid, exit_code, rusage = os.wait4(process.pid, 0)
-    else:
-        exit_code = process.wait()
-        rusage = None
-
-    if mode == Mode.SYNC:
-        venv = package_dir.joinpath(".venv")
-        if venv.exists():
-            shutil.rmtree(venv)
+    try:
+        stdout, stderr = await communicate(
+            process, specification if mode == Mode.COMPILE else None
+        )
 
-    max_rss = rusage.ru_maxrss if rusage else 0
+        # At this point the process should be finished, stdout and stderr being closed usually means that.
+        # The process is a zombie, so has called `exit()`, but we haven't reaped it with `wait`/`wait4` yet.
+        exit_code, max_rss = await wait4(process)
+    except BaseException:
+        # When another run fails or we're cancelled, don't leave uv running in the
+        # background, writing into a half-built output directory.
+        process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        raise
 
-    package_dir.joinpath("stdout.txt").write_text(stdout)
-    package_dir.joinpath("stderr.txt").write_text(stderr)
+    package_dir.joinpath("stdout.txt").write_bytes(stdout)
+    package_dir.joinpath("stderr.txt").write_bytes(stderr)
     summary = Summary(
         package=package, exit_code=exit_code, max_rss=max_rss, time=time.time() - start
     )
-    package_dir.joinpath("summary.json").write_text(json.dumps(summary.__dict__))
+    # orjson serializes dataclasses natively
+    package_dir.joinpath("summary.json").write_bytes(orjson.dumps(summary))
     return summary
 
 
+def default_concurrency() -> int:
+    """How many uv processes to run at once."""
+    return (os.cpu_count() or 1) * 2
+
+
+class Skipped(Enum):
+    """Why a `pyproject.toml` is skipped."""
+
+    NO_PROJECT = "no-project"
+    DYNAMIC_DEPENDENCIES = "dynamic-dependencies"
+
+
+def prepare_pyproject_toml(file: Path, i_am_in_docker: bool) -> str | Skipped:
+    """Read a `pyproject.toml` and prepare it for resolving."""
+    project_toml = file.read_text()
+    data = tomllib.loads(project_toml)
+    project = data.get("project")
+    if not project:
+        return Skipped.NO_PROJECT
+    # Writing the TOML is slow, only do it when we changed something
+    modified = False
+    # Remove file references that we didn't download
+    for key in ["readme", "license-files", "license"]:
+        if key in project:
+            del project[key]
+            modified = True
+    if dynamic := project.get("dynamic"):
+        if "dependencies" in dynamic and not i_am_in_docker:
+            return Skipped.DYNAMIC_DEPENDENCIES
+        if "version" in dynamic:
+            dynamic.remove("version")
+        # Usually there are no cycles back to the current project, so any version works
+        project["version"] = "1.0.0"
+        modified = True
+
+    if not modified:
+        return project_toml
+    return tomli_w.dumps(data)
+
+
 def prepare_uv_command(
-    specification: str,
     uv: Path,
     mode: Mode,
     cache: Path,
     offline: bool,
-    package_dir: Path,
     python: str,
     i_am_in_docker: bool = False,
 ) -> list[Path | str]:
+    """The uv command for the mode, it's the same for all packages."""
     # Support relative paths such as `./uv-main`
     uv = uv.resolve()
 
@@ -121,24 +158,11 @@ def prepare_uv_command(
         shared_args.append("--no-build")
     if offline:
         shared_args.append("--offline")
-    if mode == Mode.PYPROJECT_TOML:
-        package_dir.joinpath("pyproject.toml").write_text(specification)
+    if mode in [Mode.PYPROJECT_TOML, Mode.LOCK]:
         command = [uv, "lock", *shared_args]
     elif mode == Mode.SYNC:
-        package_dir.joinpath("pyproject.toml").write_text(specification)
         # TODO(konsti): Add a git clone mode that can install the project
         command = [uv, "sync", "--no-install-project", *shared_args]
-    elif mode == Mode.LOCK:
-        package_dir.joinpath("pyproject.toml").write_text(
-            f"""
-            [project]
-            name = "testing"
-            version = "0.1.0"
-            requires-python = ">={python}"
-            dependencies = ["{specification}"]
-            """
-        )
-        command = [uv, "lock", *shared_args]
     elif mode == Mode.COMPILE:
         command = [
             uv,
@@ -158,20 +182,113 @@ def prepare_uv_command(
     return command
 
 
-def communicate(process: subprocess.Popen, stdin: str | None) -> tuple[str, str]:
+def write_project(
+    specification: str, mode: Mode, package_dir: Path, python: str
+) -> None:
+    """Write the `pyproject.toml` of a package, compile passes it with stdin instead."""
+    if mode in [Mode.PYPROJECT_TOML, Mode.SYNC]:
+        package_dir.joinpath("pyproject.toml").write_text(specification)
+    elif mode == Mode.LOCK:
+        package_dir.joinpath("pyproject.toml").write_text(
+            f"""
+            [project]
+            name = "testing"
+            version = "0.1.0"
+            requires-python = ">={python}"
+            dependencies = ["{specification}"]
+            """
+        )
+
+
+async def communicate(
+    process: subprocess.Popen, stdin: str | None
+) -> tuple[bytes, bytes]:
     """Like `Popen.communicate`, but without the `os.wait` call.
 
-    Start threads to drain the pipes to avoid blocking on full pipes, but don't use
-    libc's `wait` so we can use `os.wait4` later.
+    Drain both pipes to avoid blocking on full pipes, but don't use libc's `wait` so
+    we can use `os.wait4` later. On unix, the event loop waits on the pipes,
+    elsewhere we read them in a thread each.
+
+    The outputs are bytes, we only write them to files, but with the newlines
+    normalized like text mode does.
     """
     # If the process already exited, we get a `BrokenPipeError`.
     try:
         if stdin:
-            process.stdin.write(stdin)
+            process.stdin.write(stdin.encode())
         process.stdin.close()
     except BrokenPipeError:
         pass
 
+    if os.name != "posix":
+        stdout, stderr = await asyncio.to_thread(communicate_threads, process)
+    else:
+        stdout, stderr = await asyncio.gather(
+            read_pipe(process.stdout), read_pipe(process.stderr)
+        )
+    return normalize_newlines(stdout), normalize_newlines(stderr)
+
+
+def normalize_newlines(data: bytes) -> bytes:
+    """Translate `\r\n` and `\r` to `\n`, like reading in text mode does."""
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+async def read_pipe(pipe) -> bytes:
+    """Read a pipe until EOF and close it, waiting in the event loop."""
+    fd = pipe.fileno()
+    chunks = []
+    while True:
+        await readable(fd)
+        # The fd is readable, so this returns what's available without blocking.
+        if chunk := os.read(fd, 65536):
+            chunks.append(chunk)
+        else:
+            break
+    pipe.close()
+    return b"".join(chunks)
+
+
+async def readable(fd: int) -> None:
+    """Wait until the fd is readable."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    loop.add_reader(fd, future.set_result, None)
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+
+
+async def wait4(process: subprocess.Popen) -> tuple[int, int]:
+    """Reap the process, returning the exit code and the max RSS (unix only)."""
+    # rusage is only available on unix
+    if os.name != "posix":
+        return await asyncio.to_thread(process.wait), 0
+
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            # Old kernels and seccomp profiles, e.g. in docker, can block `pidfd_open`.
+            pass
+
+    if pidfd is not None:
+        # On linux, a pidfd becomes readable when the process exits, so we can wait in
+        # the event loop and `os.wait4` returns immediately.
+        try:
+            await readable(pidfd)
+        finally:
+            os.close(pidfd)
+        _pid, exit_code, rusage = os.wait4(process.pid, 0)
+    else:
+        _pid, exit_code, rusage = await asyncio.to_thread(os.wait4, process.pid, 0)
+    return exit_code, rusage.ru_maxrss
+
+
+def communicate_threads(process: subprocess.Popen) -> tuple[bytes, bytes]:
+    """Read stdout and stderr in a thread each."""
     # Mutable objects to communicate across threads
     stdout = []
     stderr = []
@@ -191,10 +308,10 @@ def communicate(process: subprocess.Popen, stdin: str | None) -> tuple[str, str]
     stdout_thread.join()
     stderr_thread.join()
 
-    return next(iter(stdout), ""), next(iter(stderr), "")
+    return next(iter(stdout), b""), next(iter(stderr), b"")
 
 
-def resolve_all(
+async def resolve_all(
     input: Path,
     output: Path,
     mode: Mode,
@@ -206,58 +323,182 @@ def resolve_all(
     limit: int | None = None,
     stats: bool = False,
     i_am_in_docker: bool = False,
+    semaphore: asyncio.Semaphore | None = None,
 ) -> None:
+    """Resolve all packages of the input, writing the outputs to `output`.
+
+    The semaphore bounds the concurrent uv processes, it can be shared between
+    multiple runs.
+    """
+    # Several runs can share the terminal, label their output, e.g. `base/lock`.
+    label = f"{output.parent.name}/{output.name}"
+    # Reading the inputs and preparing the `pyproject.toml` files blocks, don't hold
+    # up the other runs on the event loop.
+    jobs = await asyncio.to_thread(
+        collect_jobs, input, mode, latest, limit, i_am_in_docker, label
+    )
+
+    if output.exists():
+        await asyncio.to_thread(shutil.rmtree, output)
+    output.mkdir(parents=True)
+    output.joinpath(".gitignore").write_text("*\n")
+    RunConfig(
+        mode=mode, python=python, latest=latest, i_am_in_docker=i_am_in_docker
+    ).write(output)
+
+    success = 0
+    all_results = []  # Track all results for analysis
+    max_package_len = max(len(package) for package in jobs)
+
+    command = prepare_uv_command(uv, mode, cache_dir, offline, python, i_am_in_docker)
+    # The environment is the same for all uv processes, `Popen` doesn't modify it.
+    env = {key: value for key, value in os.environ.items() if key != "VIRTUAL_ENV"}
+    # A single event loop supervises the uv processes, bounded by the semaphore.
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(default_concurrency())
+
+    # Removing the venvs takes a while, they get their own threads so they don't hold
+    # up reaping processes in the default executor. The semaphore bounds the venvs
+    # waiting for deletion, it's taken before releasing the uv process slot.
+    deletions = asyncio.Semaphore(default_concurrency())
+    delete_executor = ThreadPoolExecutor(max_workers=default_concurrency())
+    loop = asyncio.get_running_loop()
+
+    async def run_one(package: str, specification: str) -> Summary:
+        async with semaphore:
+            summary = await run_uv(
+                package, specification, command, mode, python, output, env
+            )
+            if mode != Mode.SYNC:
+                return summary
+            await deletions.acquire()
+        # Delete the venv after releasing the slot so the next uv process doesn't
+        # wait for it.
+        try:
+            venv = output.joinpath(package, ".venv")
+            if venv.exists():
+                await loop.run_in_executor(delete_executor, shutil.rmtree, venv)
+        finally:
+            deletions.release()
+        return summary
+
+    tasks = [
+        asyncio.create_task(run_one(package, specification))
+        for package, specification in jobs.items()
+    ]
+    # Show the oldest pending package, usually the slowest one. Instead of removing
+    # from a list, we skip over the finished packages in the queue.
+    packages_pending = set(jobs)
+    packages_queue = deque(jobs)
+    total = len(jobs)
+
+    with delete_executor, tqdm(total=total, desc=label) as progress_bar:
+        for result in asyncio.as_completed(tasks):
+            summary = await result
+
+            all_results.append(summary)
+            progress_bar.update(1)
+            packages_pending.remove(summary.package)
+            while packages_queue and packages_queue[0] not in packages_pending:
+                packages_queue.popleft()
+            if packages_queue:
+                progress_bar.set_postfix_str(f"{packages_queue[0]:>{max_package_len}}")
+            if summary.exit_code == 0:
+                success += 1
+
+    tqdm.write(f"{label}: Success: {success}/{total} ({success / total:.0%})")
+
+    successes = [summary for summary in all_results if summary.exit_code == 0]
+
+    if stats:
+        tqdm.write(f"\n# {label}: top 5 slowest resolutions for successes")
+        slowest = sorted(successes, key=lambda x: x.time, reverse=True)[:5]
+        for summary in slowest:
+            tqdm.write(
+                f"{label}: {summary.package}: {summary.time:.2f}s "
+                f"(exit code: {summary.exit_code})"
+            )
+
+        if os.name == "posix":
+            tqdm.write(f"\n# {label}: top 5 max RSS for successes")
+            largest_rss = sorted(successes, key=lambda x: x.max_rss, reverse=True)[:5]
+            for summary in largest_rss:
+                # On linux, max RSS is in KB, on macOS, it is in bytes
+                if platform.system() == "Linux":
+                    max_rss = summary.max_rss / 1024
+                elif platform.system() == "Darwin":
+                    max_rss = summary.max_rss / 1024 / 1024
+                else:
+                    raise NotImplementedError(f"Unknown platform: {platform.system()}")
+                tqdm.write(
+                    f"{label}: {summary.package}: {max_rss:.1f} MB "
+                    f"(exit code: {summary.exit_code})"
+                )
+
+
+def collect_jobs(
+    input: Path,
+    mode: Mode,
+    latest: bool,
+    limit: int | None,
+    i_am_in_docker: bool,
+    label: str,
+) -> dict[str, str]:
+    """Read the packages from the input, with the specification to resolve for each.
+
+    `label` prefixes the output, to tell the runs apart.
+    """
     if mode in [Mode.PYPROJECT_TOML, Mode.SYNC]:
-        project_tomls = sorted((file.stem, file) for file in input.iterdir())
+        project_tomls = sorted(
+            (file.stem, file) for file in input.iterdir() if file.suffix == ".toml"
+        )
         jobs = {}
         no_project = 0
         dynamic_dependencies = 0
-        for package, file in project_tomls:
-            if limit and len(jobs) >= limit:
-                break
-            if file.suffix != ".toml":
-                continue
-            project_toml = file.read_text()
-            data = tomllib.loads(project_toml)
-            project = data.get("project")
-            if project:
-                # Remove file references that we didn't download
-                if "readme" in project:
-                    del project["readme"]
-                if "license-files" in project:
-                    del project["license-files"]
-                if "license" in project:
-                    del project["license"]
-            else:
-                no_project += 1
-                continue
-            if dynamic := project.get("dynamic"):
-                if "dependencies" in dynamic and not i_am_in_docker:
+        # Parsing and writing TOML is pure Python, use processes to use all cores.
+        # `buffersize` avoids preparing all files when there's a limit.
+        workers = os.process_cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                prepare_pyproject_toml,
+                [file for _package, file in project_tomls],
+                itertools.repeat(i_am_in_docker),
+                chunksize=16,
+                buffersize=workers * 2,
+            )
+            for (package, _file), result in zip(project_tomls, results):
+                if limit and len(jobs) >= limit:
+                    break
+                if result == Skipped.NO_PROJECT:
+                    no_project += 1
+                elif result == Skipped.DYNAMIC_DEPENDENCIES:
                     dynamic_dependencies += 1
-                    continue
-                if "version" in dynamic:
-                    dynamic.remove("version")
-                # Usually there are no cycles back to the current project, so any version works
-                project["version"] = "1.0.0"
-
-            jobs[package] = tomli_w.dumps(data)
+                else:
+                    jobs[package] = result
 
-        print(f"`pyproject.toml`s without `[project]`: {no_project}")
+        tqdm.write(f"{label}: `pyproject.toml`s without `[project]`: {no_project}")
         if not i_am_in_docker:
-            print(
-                f"`pyproject.toml`s with `dynamic = ['dependencies']`: {dynamic_dependencies}"
+            tqdm.write(
+                f"{label}: `pyproject.toml`s with `dynamic = ['dependencies']`: "
+                f"{dynamic_dependencies}"
             )
         if latest:
             raise ValueError("Latest versions are not supported in pyproject-toml mode")
     else:
+        # `csv.reader` avoids creating a dict for each row
         with input.open() as f:
-            project_names = sorted(row["project"] for row in csv.DictReader(f))
+            reader = csv.reader(f)
+            project_index = next(reader).index("project")
+            project_names = sorted(row[project_index] for row in reader)
 
         if latest:
             with top_15k_pypi_latest_version.open() as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                name_index = header.index("package_name")
+                version_index = header.index("latest_version")
                 latest_versions = {
-                    row["package_name"]: row["latest_version"]
-                    for row in csv.DictReader(f)
+                    row[name_index]: row[version_index] for row in reader
                 }
         else:
             latest_versions = None
@@ -268,7 +509,7 @@ def resolve_all(
                 if version := latest_versions.get(package):
                     jobs[package] = f"{package}=={version}"
                 else:
-                    tqdm.write(f"Missing version: {package}")
+                    tqdm.write(f"{label}: Missing version: {package}")
                     continue
             else:
                 jobs[package] = package
@@ -288,81 +529,7 @@ def resolve_all(
     ]
     for package in excluded_packages:
         jobs.pop(package, None)
-
-    if output.exists():
-        shutil.rmtree(output)
-    output.mkdir(parents=True)
-    output.joinpath(".gitignore").write_text("*\n")
-    RunConfig(
-        mode=mode, python=python, latest=latest, i_am_in_docker=i_am_in_docker
-    ).write(output)
-
-    success = 0
-    all_results = []  # Track all results for analysis
-    max_package_len = max(len(package) for package in jobs)
-
-    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
-        tasks = []
-        packages_pending = []
-        for package, specification in jobs.items():
-            packages_pending.append(package)
-
-            tasks.append(
-                executor.submit(
-                    run_uv,
-                    package,
-                    specification,
-                    uv,
-                    mode,
-                    python,
-                    cache_dir,
-                    offline,
-                    output,
-                    i_am_in_docker=i_am_in_docker,
-                )
-            )
-        total = len(packages_pending)
-
-        with tqdm(total=total) as progress_bar:
-            for result in concurrent.futures.as_completed(tasks):
-                summary = result.result()
-
-                all_results.append(summary)
-                progress_bar.update(1)
-                packages_pending.remove(summary.package)
-                if packages_pending:
-                    progress_bar.set_postfix_str(
-                        f"{packages_pending[0]:>{max_package_len}}"
-                    )
-                if summary.exit_code == 0:
-                    success += 1
-
-    print(f"Success: {success}/{total} ({success / total:.0%})")
-
-    successes = [summary for summary in all_results if summary.exit_code == 0]
-
-    if stats:
-        print("\n# top 5 slowest resolutions for successes")
-        slowest = sorted(successes, key=lambda x: x.time, reverse=True)[:5]
-        for summary in slowest:
-            print(
-                f"{summary.package}: {summary.time:.2f}s (exit code: {summary.exit_code})"
-            )
-
-        if os.name == "posix":
-            print("\n# top 5 max RSS for successes")
-            largest_rss = sorted(successes, key=lambda x: x.max_rss, reverse=True)[:5]
-            for summary in largest_rss:
-                # On linux, max RSS is in KB, on macOS, it is in bytes
-                if platform.system() == "Linux":
-                    max_rss = summary.max_rss / 1024
-                elif platform.system() == "Darwin":
-                    max_rss = summary.max_rss / 1024 / 1024
-                else:
-                    raise NotImplementedError(f"Unknown platform: {platform.system()}")
-                print(
-                    f"{summary.package}: {max_rss:.1f} MB (exit code: {summary.exit_code})"
-                )
+    return jobs
 
 
 def main():
@@ -400,18 +567,20 @@ def main():
     else:
         input_path = args.input
 
-    resolve_all(
-        input_path,
-        args.output,
-        Mode(args.mode),
-        args.uv,
-        args.cache,
-        args.python,
-        args.offline,
-        args.latest,
-        args.limit,
-        args.stats,
-        args.i_am_in_docker,
+    run_async(
+        resolve_all(
+            input_path,
+            args.output,
+            Mode(args.mode),
+            args.uv,
+            args.cache,
+            args.python,
+            args.offline,
+            args.latest,
+            args.limit,
+            args.stats,
+            args.i_am_in_docker,
+        )
     )
 
 
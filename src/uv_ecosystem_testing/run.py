@@ -2,6 +2,8 @@ import argparse
 import asyncio
 from pathlib import Path
 
+from tqdm.auto import tqdm
+
 from uv_ecosystem_testing import (
     cache_dir,
     root_dir,
@@ -10,10 +12,10 @@ from uv_ecosystem_testing import (
     top5k_pyproject_toml_2025_gh_stars,
     mypy_primer,
     Mode,
+    run_async,
 )
 from uv_ecosystem_testing.report import create_report
-from uv_ecosystem_testing.fetch_pyproject_toml import fetch_all_pyproject_toml
-from uv_ecosystem_testing.resolve import resolve_all
+from uv_ecosystem_testing.resolve import default_concurrency, resolve_all
 
 
 def main():
@@ -36,7 +38,7 @@ def main():
     )
     args = parser.parse_args()
 
-    asyncio.run(
+    run_async(
         run(
             args.uv_base,
             args.uv_branch,
@@ -73,104 +75,72 @@ async def run(
     branch.mkdir(exist_ok=True, parents=True)
     branch.joinpath(".gitignore").write_text("*\n")
 
-    if not pyproject_tomls_dir.is_dir():
+    inputs = {
+        Mode.COMPILE: top_15k_pypi,
+        Mode.LOCK: top_15k_pypi,
+        Mode.PYPROJECT_TOML: pyproject_tomls_dir,
+    }
+    if latest:
+        # The `pyproject.toml` files have no versions to update. Skip the mode instead
+        # of failing while the other modes are running.
+        tqdm.write("Skipping pyproject-toml mode, latest versions are not supported")
+        del inputs[Mode.PYPROJECT_TOML]
+
+    if Mode.PYPROJECT_TOML in inputs and not pyproject_tomls_dir.is_dir():
+        # Only import httpx when we need to download the files
+        from uv_ecosystem_testing.fetch_pyproject_toml import fetch_all_pyproject_toml
+
         await fetch_all_pyproject_toml(
             [top5k_pyproject_toml_2025_gh_stars, mypy_primer], pyproject_tomls_dir
         )
 
+    # The output directories of base and branch for each mode
+    outputs = {
+        mode: (base.joinpath(mode.value), branch.joinpath(mode.value))
+        for mode in inputs
+    }
+
     if not only_report:
-        resolve_all(
-            top_15k_pypi,
-            base.joinpath("compile"),
-            Mode.COMPILE,
-            uv_base,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
-        )
-        resolve_all(
-            top_15k_pypi,
-            branch.joinpath("compile"),
-            Mode.COMPILE,
-            uv_branch,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
-        )
-        resolve_all(
-            top_15k_pypi,
-            base.joinpath("lock"),
-            Mode.LOCK,
-            uv_base,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
+        # The modes and binaries are independent, run them all at the same time, so
+        # there's no idle time in the tail of each run. uv's cache supports concurrent
+        # access. A single semaphore bounds the uv processes across all runs, so a run
+        # that finishes early leaves its share to the others.
+        runs = [
+            (inputs[mode], mode, output, uv)
+            for mode, (output_base, output_branch) in outputs.items()
+            for output, uv in [(output_base, uv_base), (output_branch, uv_branch)]
+        ]
+        semaphore = asyncio.Semaphore(default_concurrency())
+        await asyncio.gather(
+            *[
+                resolve_all(
+                    input,
+                    output,
+                    mode,
+                    uv,
+                    cache_dir=cache,
+                    limit=limit,
+                    latest=latest,
+                    python=python,
+                    offline=offline,
+                    i_am_in_docker=i_am_in_docker,
+                    semaphore=semaphore,
+                )
+                for input, mode, output, uv in runs
+            ]
         )
-        resolve_all(
-            top_15k_pypi,
-            branch.joinpath("lock"),
-            Mode.LOCK,
-            uv_branch,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
-        )
-        resolve_all(
-            pyproject_tomls_dir,
-            base.joinpath("pyproject-toml"),
-            Mode.PYPROJECT_TOML,
-            uv_base,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
-        )
-        resolve_all(
-            pyproject_tomls_dir,
-            branch.joinpath("pyproject-toml"),
-            Mode.PYPROJECT_TOML,
-            uv_branch,
-            cache_dir=cache,
-            limit=limit,
-            latest=latest,
-            python=python,
-            offline=offline,
-            i_am_in_docker=i_am_in_docker,
-        )
-
-    create_report(base.joinpath("compile"), branch.joinpath("compile"), False)
-    create_report(base.joinpath("lock"), branch.joinpath("lock"), False)
-    create_report(
-        base.joinpath("pyproject-toml"), branch.joinpath("pyproject-toml"), False
-    )
 
+    # Write the text and the markdown report from a single pass over the outputs
     if report:
-        with report.open("w") as writer:
+        # The report is written in many small pieces, buffer them so we write in large
+        # chunks, without keeping the whole report with all diffs in memory.
+        with report.open("w", buffering=1024 * 1024) as writer:
             writer.write("## Ecosystem testing report\n")
-            create_report(
-                base.joinpath("compile"), branch.joinpath("compile"), True, writer
-            )
-            create_report(base.joinpath("lock"), branch.joinpath("lock"), True, writer)
-            create_report(
-                base.joinpath("pyproject-toml"),
-                branch.joinpath("pyproject-toml"),
-                True,
-                writer,
-            )
+            for output_base, output_branch in outputs.values():
+                create_report(output_base, output_branch, markdown_writer=writer)
+    else:
+        for output_base, output_branch in outputs.values():
+            create_report(output_base, output_branch)
 
 
 if __name__ == "__main__":